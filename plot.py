@@ -1,12 +1,21 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import argparse
-import json
+import orjson
 
 def plot_3d(data, ax, name):
-    x = [i[0] for i in data]
-    y = [i[1] for i in data]
-    z = [i[2] for i in data]
-    ax.plot_trisurf(x, y, z, label=name, alpha=0.7)
+    arr = np.asarray(data, dtype=np.float64)
+    arr = arr[np.lexsort((arr[:, 1], arr[:, 0]))]
+    m = np.unique(arr[:, 0])
+    n = np.unique(arr[:, 1])
+    if len(m) > 1 and len(n) > 1 and len(m) * len(n) == len(arr):
+        # the sweep samples a regular (M, N) grid, so a reshaped
+        # plot_surface avoids trisurf's Delaunay triangulation
+        x, y = np.meshgrid(m, n, indexing='ij')
+        z = arr[:, 2].reshape(len(m), len(n))
+        ax.plot_surface(x, y, z, label=name, alpha=0.7)
+    else:
+        ax.plot_trisurf(arr[:, 0], arr[:, 1], arr[:, 2], label=name, alpha=0.7)
 
 def main():
     parser = argparse.ArgumentParser(description='Plot miss rate of different loop orders')
@@ -14,11 +23,11 @@ def main():
     args = parser.parse_args()
     data = {}
     if args.input:
-        with open(args.input, 'r') as f:
-            data = json.load(f)
+        with open(args.input, 'rb') as f:
+            data = orjson.loads(f.read())
     else:
         allinput = input()
-        data = json.loads(allinput)
+        data = orjson.loads(allinput)
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
     for name, results in data.items():
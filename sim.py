@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Instrumented in-process cache simulator for the matmul sweep.
+
+Emulates a set-associative LRU data cache access-by-access, like
+cachegrind's D1 but without the clang + valgrind roundtrip (~1s per
+point versus ~ms once numba has JIT-compiled the kernel). Unlike the
+closed-form model in ordered.py this handles conflicts between the
+operands, arbitrary associativity, and any loop order.
+"""
+
+import numpy as np
+
+try:
+    import numba
+    _njit = numba.njit(cache=True)
+except ImportError:  # numba only accelerates the simulation
+    _njit = lambda f: f
+
+# loop variables per order id: 0 = i (trip M), 1 = j (trip M), 2 = k (trip N);
+# numbering matches ordered.ORDER_IDS
+_PERMS = ((0, 1, 2), (0, 2, 1), (1, 0, 2), (1, 2, 0), (2, 0, 1), (2, 1, 0))
+
+_ELEM = 8  # sizeof(double)
+
+
+@_njit
+def simulate(M, N, order, cache_size, block_size, assoc):
+    """Return (misses, refs) of the D1 cache for one (M, N, order) point."""
+    if assoc == 0:
+        assoc = cache_size // block_size
+    nsets = cache_size // (block_size * assoc)
+    tags = np.full(nsets * assoc, -1, dtype=np.int64)
+    stamps = np.zeros(nsets * assoc, dtype=np.int64)
+    # operand base addresses mirror the C template's arena slicing
+    base_a = 0
+    base_b = M * N * _ELEM
+    base_c = 2 * M * N * _ELEM
+    perm = _PERMS[order]
+    trips = (M, M, N)
+    idx = np.zeros(3, dtype=np.int64)
+    misses = 0
+    refs = 0
+    clock = 0
+    for x0 in range(trips[perm[0]]):
+        idx[perm[0]] = x0
+        for x1 in range(trips[perm[1]]):
+            idx[perm[1]] = x1
+            for x2 in range(trips[perm[2]]):
+                idx[perm[2]] = x2
+                i = idx[0]
+                j = idx[1]
+                k = idx[2]
+                # C[i*M+j] += A[i*N+k] * B[k*M+j]: two reads, then a
+                # read-modify-write of C (the write always hits the line
+                # the read just fetched, so it only counts as a ref)
+                for addr in (base_a + (i * N + k) * _ELEM,
+                             base_b + (k * M + j) * _ELEM,
+                             base_c + (i * M + j) * _ELEM):
+                    line = addr // block_size
+                    base = (line % nsets) * assoc
+                    clock += 1
+                    refs += 1
+                    hit = False
+                    for w in range(assoc):
+                        if tags[base + w] == line:
+                            stamps[base + w] = clock
+                            hit = True
+                            break
+                    if not hit:
+                        misses += 1
+                        victim = base
+                        for w in range(1, assoc):
+                            if stamps[base + w] < stamps[victim]:
+                                victim = base + w
+                        tags[victim] = line
+                        stamps[victim] = clock
+                refs += 1  # the write half of the C update
+    return misses, refs
+
+
+def miss_rate(M, N, order, cache_size, block_size, assoc=None):
+    misses, refs = simulate(M, N, order, cache_size, block_size, assoc or 0)
+    if refs == 0:
+        return 0
+    return misses / refs
+
+
+def sim_execute(order_id, cache_size, block_size, assoc, m_range, n_range):
+    return [(m, n, miss_rate(m, n, order_id, cache_size, block_size, assoc))
+            for m in range(*m_range) for n in range(*n_range)]